@@ -5,8 +5,27 @@ friendly class based views. Send e-mails in Django is currently still a
 bastardized procedure, which Paloma aims to mitigate.
 """
 
+import random
+import re
+import uuid
+from datetime import datetime, timedelta
+
 from django.conf import settings
 from django.core.mail import EmailMultiAlternatives
+from django.utils import six
+from django.utils.html import conditional_escape, escape
+from django.utils.timezone import get_current_timezone
+
+from .attachments import (encoded_size,
+                          get_attachment_store,
+                          get_attachment_url)
+from .merge import is_mergeable
+from .spool import get_spool
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    from django.utils.encoding import force_unicode as force_text
 
 
 if 'coffin' in settings.INSTALLED_APPS:
@@ -21,6 +40,19 @@ class Mail(object):
     :ivar subject: Subject of the e-mail.
     :ivar from_email: Sender's e-mail address.
     :ivar from_name: Sender's name.
+    :ivar delivery_window:
+        Tuple of the :class:`datetime.time` the window for delivering the
+        e-mail starts and ends at in the recipient's time zone. E-mails sent
+        outside the window are spooled until a random time within the next
+        window. The window may span midnight, but must not be empty, so the
+        start and end must differ.
+    :ivar attachment_size_limit:
+        Maximum size of the e-mail in bytes. If the e-mail is larger, the
+        largest attachments are replaced with download links until it fits.
+    :ivar attachment_urls:
+        Download links of offloaded attachments by filename, as tuples of the
+        attachment data, MIME type and link, reused for every recipient the
+        e-mail is sent to.
     """
 
     subject = None
@@ -31,6 +63,8 @@ class Mail(object):
     bcc = None
     headers = None
     important = None
+    delivery_window = None
+    attachment_size_limit = None
 
     def __init__(self,
                  subject=None,
@@ -39,7 +73,9 @@ class Mail(object):
                  cc=None,
                  bcc=None,
                  headers=None,
-                 important=None):
+                 important=None,
+                 delivery_window=None,
+                 attachment_size_limit=None):
         """Initialize an e-mail.
 
         :param subject: Subject of the e-mail.
@@ -53,6 +89,12 @@ class Mail(object):
             List of emails this message should be CC'd to
         :param bcc:
             List of emails this message should be BCC'd to
+        :param delivery_window:
+            Tuple of the :class:`datetime.time` the window for delivering the
+            e-mail starts and ends at in the recipient's time zone.
+        :param attachment_size_limit:
+            Maximum size of the e-mail in bytes before attachments are
+            replaced with download links.
         """
 
         if subject:
@@ -73,7 +115,145 @@ class Mail(object):
             self.headers = headers
         if important:
             self.important = important
+        if delivery_window:
+            self.delivery_window = delivery_window
+        if self.delivery_window and \
+                self.delivery_window[0] == self.delivery_window[1]:
+            raise ValueError('the delivery window must not be empty')
+        if attachment_size_limit:
+            self.attachment_size_limit = attachment_size_limit
         self.attachments = {}
+        self.attachment_urls = {}
+
+    def get_send_at(self, timezone=None, now=None):
+        """Get the time to send the e-mail within the delivery window.
+
+        :param timezone:
+            Time zone of the recipient. If ``None``, defaults to the current
+            time zone if ``USE_TZ`` is set, and local time otherwise.
+        :param now:
+            Current time. If ``None``, the current time is used. Default
+            ``None``.
+        :returns:
+            a random time within the next delivery window, or ``None`` if the
+            delivery window is open.
+        """
+
+        start, end = self.delivery_window
+        if timezone is None and getattr(settings, 'USE_TZ', False):
+            timezone = get_current_timezone()
+
+        if now is None:
+            now = datetime.now(timezone)
+        elif timezone is not None:
+            now = now.astimezone(timezone)
+        current = now.time().replace(tzinfo=None)
+
+        # Send right away if the window is open.
+        if start <= end:
+            if start <= current < end:
+                return None
+        elif current >= start or current < end:
+            return None
+
+        day = now.date()
+        if current >= start:
+            day += timedelta(days=1)
+
+        # Pick a random wall clock time within the window, and only then
+        # attach the time zone, so the UTC offset is right for that time even
+        # if the window spans a daylight saving time change.
+        window_start = datetime.combine(day, start)
+        window_end = datetime.combine(day, end)
+        if end <= start:
+            window_end += timedelta(days=1)
+        duration = window_end - window_start
+
+        send_at = window_start + timedelta(
+            seconds=random.random() * (duration.days * 86400 +
+                                       duration.seconds)
+        )
+
+        if timezone is None:
+            return send_at
+        if hasattr(timezone, 'localize'):
+            return timezone.normalize(timezone.localize(send_at))
+        return send_at.replace(tzinfo=timezone)
+
+    def compact(self, text_body, html_body=None):
+        """Replace the largest attachments with links to fit the size limit.
+
+        Attachments are offloaded, largest first, to the store configured by
+        the ``PALOMA_ATTACHMENT_DIR`` setting until the encoded size of the
+        e-mail is within :attr:`attachment_size_limit`, and links to them are
+        appended to the bodies.
+
+        :param text_body: Plain text e-mail body.
+        :param html_body: Rich HTML e-mail body.
+        :returns:
+            a tuple of the plain text body, HTML body and the attachments to
+            send with the e-mail.
+        """
+
+        attachments = dict(self.attachments)
+
+        text_body = force_text(text_body)
+        if html_body:
+            html_body = force_text(html_body)
+
+        size = len(text_body.encode('utf-8'))
+        if html_body:
+            size += len(html_body.encode('utf-8'))
+        for data, mime_type in attachments.values():
+            size += encoded_size(data)
+
+        if size <= self.attachment_size_limit:
+            return text_body, html_body, attachments
+
+        links = []
+        for filename in sorted(attachments,
+                               key=lambda f: len(attachments[f][0]),
+                               reverse=True):
+            if size <= self.attachment_size_limit:
+                break
+
+            data, mime_type = attachments.pop(filename)
+            size -= encoded_size(data)
+
+            # Only store and sign each attachment once per e-mail.
+            cached_data, cached_mime_type, url = self.attachment_urls.get(
+                filename,
+                (None, None, None)
+            )
+            if cached_data is not data or cached_mime_type != mime_type:
+                url = get_attachment_url(get_attachment_store().save(data),
+                                         filename,
+                                         mime_type)
+                self.attachment_urls[filename] = (data, mime_type, url)
+
+            links.append((filename, url))
+
+        if not links:
+            return text_body, html_body, attachments
+
+        text_body += u'\n\nAttachments:\n' + u''.join(
+            u'\n%s: %s' % (filename, url) for filename, url in links
+        )
+
+        if html_body:
+            html_links = u'<p>Attachments:</p><ul>%s</ul>' % (u''.join(
+                u'<li><a href="%s">%s</a></li>' % (escape(url),
+                                                   escape(filename))
+                for filename, url in links
+            ))
+
+            index = html_body.lower().rfind('</body>')
+            if index == -1:
+                html_body += html_links
+            else:
+                html_body = html_body[:index] + html_links + html_body[index:]
+
+        return text_body, html_body, attachments
 
     def send(self,
              to,
@@ -85,7 +265,9 @@ class Mail(object):
              cc=None,
              bcc=None,
              headers=None,
-             important=None):
+             important=None,
+             send_at=None,
+             timezone=None):
         """Send the e-mail.
 
         :param to: Recipient of the e-mail.
@@ -97,8 +279,18 @@ class Mail(object):
         :param metadata: dict of mandrill metadata
         :param cc: list of emails this message should be CC'd to
         :param bcc: list of emails this message should be BCC'd to
+        :param send_at:
+            Time to send the e-mail at. If provided, the e-mail is spooled to
+            be sent by the ``drain_spool`` management command once due. If
+            ``None``, the e-mail is sent within the delivery window, if any.
+        :param timezone: Time zone of the recipient for the delivery window.
         """
 
+        attachments = self.attachments
+        if self.attachment_size_limit is not None:
+            text_body, html_body, attachments = self.compact(text_body,
+                                                             html_body)
+
         from_combined = '%s <%s>' % (
             self.from_name,
             self.from_email
@@ -120,7 +312,7 @@ class Mail(object):
             message.attach_alternative(html_body, "text/html")
 
         # Attach any files.
-        for filename, (data, mime_type) in self.attachments.items():
+        for filename, (data, mime_type) in attachments.items():
             message.attach(filename, data, mime_type)
 
         # Optional Mandrill-specific extensions:
@@ -134,8 +326,14 @@ class Mail(object):
         if important is not None:
             message.important = important
 
-        # Send the message.
-        message.send()
+        if send_at is None and self.delivery_window:
+            send_at = self.get_send_at(timezone)
+
+        # Send the message, or spool it to be sent later.
+        if send_at is None:
+            message.send()
+        else:
+            get_spool().enqueue(message, send_at)
 
     def attach_file(self,
                     filename,
@@ -173,12 +371,17 @@ class TemplateMail(Mail):
         Template to use for the plain text body of the e-mail.
     :ivar html_template_name:
         Template to use for the HTML body of the e-mail.
+    :ivar merge_variables:
+        Names of the context variables that differ between recipients when
+        sending with :meth:`send_many`. The templates are rendered once and
+        the merge variables are filled in for each recipient.
     """
 
     subject_template_name = None
     text_template_name = None
     html_template_name = None
     context = None
+    merge_variables = None
 
     def __init__(self,
                  subject_template_name=None,
@@ -191,7 +394,10 @@ class TemplateMail(Mail):
                  cc=None,
                  bcc=None,
                  headers=None,
-                 important=None):
+                 important=None,
+                 merge_variables=None,
+                 delivery_window=None,
+                 attachment_size_limit=None):
         """Initialize a template based e-mail.
 
         :param subject_template_name:
@@ -213,6 +419,15 @@ class TemplateMail(Mail):
             List of emails this message should be CC'd to
         :param bcc:
             List of emails this message should be BCC'd to
+        :param merge_variables:
+            Names of the context variables that differ between recipients
+            when sending with :meth:`send_many`.
+        :param delivery_window:
+            Tuple of the :class:`datetime.time` the window for delivering the
+            e-mail starts and ends at in the recipient's time zone.
+        :param attachment_size_limit:
+            Maximum size of the e-mail in bytes before attachments are
+            replaced with download links.
         """
 
         if subject_template_name:
@@ -227,13 +442,20 @@ class TemplateMail(Mail):
         elif not self.context:
             self.context = {}
 
-        super(TemplateMail, self).__init__(subject=subject,
-                                           from_email=from_email,
-                                           from_name=from_name,
-                                           cc=cc,
-                                           bcc=bcc,
-                                           headers=headers,
-                                           important=important)
+        if merge_variables:
+            self.merge_variables = merge_variables
+
+        super(TemplateMail, self).__init__(
+            subject=subject,
+            from_email=from_email,
+            from_name=from_name,
+            cc=cc,
+            bcc=bcc,
+            headers=headers,
+            important=important,
+            delivery_window=delivery_window,
+            attachment_size_limit=attachment_size_limit
+        )
 
     def render_template(self, template_name, context):
         """Render a template.
@@ -246,22 +468,13 @@ class TemplateMail(Mail):
 
         return render_to_string(template_name, context)
 
-    def send(self,
-             to,
-             context=None,
-             tags=None,
-             metadata=None,
-             cc=None,
-             bcc=None,
-             headers=None,
-             important=None):
-        """Send the e-mail.
+    def get_context(self, context=None):
+        """Get the template context for a recipient.
 
-        :param to: Recipient of the e-mail.
         :param context: Recipient-specific template context.
+        :returns: the recipient independent context updated with ``context``.
         """
 
-        # Construct the local context.
         local_context = {}
         if self.context:
             for k, v in self.context.items():
@@ -270,21 +483,179 @@ class TemplateMail(Mail):
             for k, v in context.items():
                 local_context[k] = v
 
-        # Render what needs to be rendered.
+        return local_context
+
+    def render_parts(self, context):
+        """Render the subject, plain text body and HTML body templates.
+
+        :param context: Template context.
+        :returns:
+            a tuple of the rendered subject, plain text body and HTML body.
+            The subject and HTML body are ``None`` if there is no template
+            for them.
+        """
+
         subject = None
         if self.subject_template_name:
-            subject = ''.join(self.render_template(self.subject_template_name,
-                                                   local_context)
-                              .strip()
-                              .splitlines())
+            subject = self.render_template(self.subject_template_name,
+                                           context)
 
-        text_body = self.render_template(self.text_template_name,
-                                         local_context).strip()
+        text_body = self.render_template(self.text_template_name, context)
 
         html_body = None
         if self.html_template_name:
             html_body = self.render_template(self.html_template_name,
-                                             local_context).strip()
+                                             context)
+
+        return subject, text_body, html_body
+
+    def clean_parts(self, subject, text_body, html_body):
+        """Clean up rendered parts for sending.
+
+        Joins the subject into a single line and strips the bodies.
+
+        :returns: a tuple of the subject, plain text body and HTML body.
+        """
+
+        if subject is not None:
+            subject = ''.join(subject.strip().splitlines())
+
+        text_body = text_body.strip()
+
+        if html_body is not None:
+            html_body = html_body.strip()
+
+        return subject, text_body, html_body
+
+    def compile_parts(self):
+        """Render the templates once with placeholders for merge variables.
+
+        The templates are first checked to only output merge variables as
+        is, see :func:`paloma.merge.is_mergeable`. Every merge variable is
+        then rendered as a unique placeholder, which is located in the
+        rendered parts to split them into literal text and substitution
+        slots. Whether a placeholder was escaped by the template engine
+        determines whether values are escaped in that slot.
+
+        :returns:
+            a list of compiled parts, each ``None`` or a tuple of a list of
+            literals and a list of ``(name, escape)`` slots between them, or
+            ``None`` if the templates use merge variables in any other way
+            than outputting them as is.
+        """
+
+        names = list(self.merge_variables)
+        template_names = [name for name in (self.subject_template_name,
+                                            self.text_template_name,
+                                            self.html_template_name)
+                          if name]
+
+        if 'coffin' in settings.INSTALLED_APPS or \
+                not is_mergeable(template_names, names):
+            return None
+
+        nonce = uuid.uuid4().hex
+
+        context = self.get_context(dict(
+            (name, 'paloma%s_%d<>' % (nonce, index))
+            for index, name in enumerate(names)
+        ))
+
+        pattern = re.compile(r'paloma%s_(\d+)(<>|&lt;&gt;)' % (nonce))
+
+        parts = []
+        for rendered in self.render_parts(context):
+            if rendered is None:
+                parts.append(None)
+                continue
+
+            pieces = pattern.split(rendered)
+            literals = pieces[::3]
+            slots = [(names[int(index)], marker != '<>')
+                     for index, marker in zip(pieces[1::3], pieces[2::3])]
+
+            if any(nonce in literal.lower() for literal in literals):
+                return None
+
+            parts.append((literals, slots))
+
+        return parts
+
+    def can_fill_parts(self, context, local_context):
+        """Whether the merge variables of a recipient can be filled in.
+
+        Only strings are filled in, as a full render localizes other values
+        and calls callables. Missing merge variables and variables other
+        than merge variables require a full render too.
+
+        :param context: Recipient-specific template context.
+        :param local_context: Template context of the recipient.
+        """
+
+        if not set(context or ()).issubset(self.merge_variables):
+            return False
+
+        for name in self.merge_variables:
+            if not isinstance(local_context.get(name),
+                              six.string_types):
+                return False
+
+        return True
+
+    def fill_parts(self, parts, context):
+        """Fill in the merge variables of compiled parts.
+
+        :param parts: Parts compiled by :meth:`compile_parts`.
+        :param context:
+            Template context of the recipient, for which
+            :meth:`can_fill_parts` holds.
+        :returns:
+            a tuple of the subject, plain text body and HTML body as returned
+            by :meth:`render_parts`.
+        """
+
+        values = {}
+        for name in self.merge_variables:
+            value = context[name]
+            values[name] = (force_text(value), conditional_escape(value))
+
+        filled = []
+        for part in parts:
+            if part is None:
+                filled.append(None)
+                continue
+
+            literals, slots = part
+            pieces = [literals[0]]
+            for (name, escaped), literal in zip(slots, literals[1:]):
+                pieces.append(values[name][1 if escaped else 0])
+                pieces.append(literal)
+            filled.append(u''.join(pieces))
+
+        return tuple(filled)
+
+    def send(self,
+             to,
+             context=None,
+             tags=None,
+             metadata=None,
+             cc=None,
+             bcc=None,
+             headers=None,
+             important=None,
+             send_at=None,
+             timezone=None):
+        """Send the e-mail.
+
+        :param to: Recipient of the e-mail.
+        :param context: Recipient-specific template context.
+        :param send_at: Time to send the e-mail at.
+        :param timezone: Time zone of the recipient for the delivery window.
+        """
+
+        subject, text_body, html_body = self.clean_parts(
+            *self.render_parts(self.get_context(context))
+        )
 
         super(TemplateMail, self).send(
             to=to,
@@ -296,5 +667,61 @@ class TemplateMail(Mail):
             cc=cc,
             bcc=bcc,
             headers=headers,
-            important=important
+            important=important,
+            send_at=send_at,
+            timezone=timezone
         )
+
+    def send_many(self,
+                  recipients,
+                  tags=None,
+                  metadata=None,
+                  cc=None,
+                  bcc=None,
+                  headers=None,
+                  important=None,
+                  send_at=None,
+                  timezone=None):
+        """Send the e-mail to many recipients.
+
+        If :attr:`merge_variables` is set, the templates are rendered once
+        and only the merge variables are filled in for each recipient.
+        Recipients whose merge variables are not all strings or whose context
+        holds other variables, and all recipients if the templates use a
+        merge variable in any other way than outputting it as is, for example
+        in a filter or an ``if`` tag, are rendered in full.
+
+        :param recipients:
+            Iterable of ``(to, context)`` tuples of a recipient and the
+            recipient-specific template context.
+        :param send_at: Time to send the e-mails at.
+        :param timezone: Time zone of the recipients for the delivery window.
+        """
+
+        parts = self.compile_parts() if self.merge_variables else None
+
+        for to, context in recipients:
+            local_context = self.get_context(context)
+
+            if parts is not None and \
+                    self.can_fill_parts(context, local_context):
+                rendered = self.fill_parts(parts, local_context)
+            else:
+                rendered = self.render_parts(local_context)
+
+            subject, text_body, html_body = self.clean_parts(*rendered)
+
+            super(TemplateMail, self).send(
+                to=to,
+                text_body=text_body,
+                html_body=html_body,
+                subject=subject,
+                tags=tags,
+                metadata=metadata,
+                cc=cc,
+                bcc=bcc,
+                headers=headers,
+                important=important,
+                send_at=send_at,
+                timezone=timezone
+            )
@@ -0,0 +1,183 @@
+"""Offloading of large attachments to signed download links.
+
+Attachments are stored by the SHA-256 hash of their contents, so identical
+attachments are only stored once however many e-mails they are offloaded
+from. Links are served by :func:`paloma.views.attachment`.
+"""
+
+import errno
+import hashlib
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.exceptions import ImproperlyConfigured
+from django.core.urlresolvers import reverse
+
+
+SALT = 'paloma.attachment'
+
+
+class AttachmentStore(object):
+    """Content-addressed store of offloaded attachments.
+
+    :ivar path: Storage directory.
+    """
+
+    def __init__(self, path):
+        """Initialize an attachment store.
+
+        :param path:
+            Storage directory. The directory is created if it does not exist.
+        """
+
+        self.path = path
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_path(self, digest):
+        """Get the path of a stored attachment.
+
+        :param digest: Hex digest of the attachment.
+        :returns: the path of the attachment.
+        """
+
+        return os.path.join(self.path, digest)
+
+    def save(self, data):
+        """Store an attachment unless an identical one is stored already.
+
+        The modification time of an attachment that is stored already is
+        updated, so :meth:`prune` keeps it for as long as new links to it may
+        be valid.
+
+        :param data: Contents of the attachment.
+        :returns: the hex digest of the attachment.
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.get_path(digest)
+
+        try:
+            os.utime(path, None)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+            temp_path = os.path.join(self.path,
+                                     '.%s.%s.tmp' % (digest, uuid.uuid4().hex))
+            with open(temp_path, 'wb') as attachment_file:
+                attachment_file.write(data)
+            os.rename(temp_path, path)
+
+        return digest
+
+    def prune(self, max_age, now=None):
+        """Remove attachments which have not been stored for a while.
+
+        :param max_age:
+            Number of seconds since an attachment was last stored after which
+            it is removed, along with temporary files left behind by
+            interrupted saves.
+        :param now:
+            POSIX timestamp to determine the age of attachments by. If
+            ``None``, the current time is used. Default ``None``.
+        :returns: the number of attachments removed.
+        """
+
+        if now is None:
+            now = time.time()
+
+        removed = 0
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+
+            try:
+                if now - os.path.getmtime(path) <= max_age:
+                    continue
+                os.remove(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+
+            if not name.endswith('.tmp'):
+                removed += 1
+
+        return removed
+
+
+def get_attachment_store():
+    """Get the store configured by the ``PALOMA_ATTACHMENT_DIR`` setting.
+
+    :returns: an :class:`AttachmentStore`.
+    """
+
+    path = getattr(settings, 'PALOMA_ATTACHMENT_DIR', None)
+    if not path:
+        raise ImproperlyConfigured('the PALOMA_ATTACHMENT_DIR setting must be '
+                                   'set to offload attachments')
+
+    return AttachmentStore(path)
+
+
+def encoded_size(data):
+    """Get the size of an attachment once base64 encoded in an e-mail.
+
+    :param data: Contents of the attachment.
+    :returns: the encoded size in bytes, including line breaks.
+    """
+
+    size = (len(data) + 2) // 3 * 4
+    return size + size // 76 * 2
+
+
+def get_attachment_url(digest, filename, mime_type=None):
+    """Get the signed download link of a stored attachment.
+
+    The link is prefixed with the ``PALOMA_ATTACHMENT_BASE_URL`` setting,
+    which must hold the scheme and domain to serve attachments from, as
+    relative links don't work in e-mails.
+
+    :param digest: Hex digest of the attachment.
+    :param filename: Filename to download the attachment as.
+    :param mime_type: MIME type of the attachment.
+    :returns: the download link.
+    """
+
+    base_url = getattr(settings, 'PALOMA_ATTACHMENT_BASE_URL', None)
+    if not base_url:
+        raise ImproperlyConfigured('the PALOMA_ATTACHMENT_BASE_URL setting '
+                                   'must be set to offload attachments')
+
+    token = signing.dumps({'d': digest, 'f': filename, 'm': mime_type},
+                          salt=SALT)
+
+    return '%s%s' % (base_url,
+                     reverse('paloma-attachment', kwargs={'token': token}))
+
+
+def load_attachment_token(token):
+    """Load a signed download link token.
+
+    Tokens expire after ``PALOMA_ATTACHMENT_MAX_AGE`` seconds, if set.
+
+    :param token: Token.
+    :returns: a tuple of the hex digest, filename and MIME type.
+    :raises django.core.signing.BadSignature:
+        if the token is invalid or has expired.
+    """
+
+    data = signing.loads(token,
+                         salt=SALT,
+                         max_age=getattr(settings,
+                                         'PALOMA_ATTACHMENT_MAX_AGE',
+                                         None))
+
+    return data['d'], data['f'], data['m']
@@ -0,0 +1,285 @@
+"""E-mail backends.
+"""
+
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .spool import get_spool
+
+
+class SpoolBackend(BaseEmailBackend):
+    """E-mail backend writing messages to the Paloma spool.
+
+    Messages are sent from the spool by the ``drain_spool`` management
+    command through the backend given by the ``PALOMA_SPOOL_BACKEND``
+    setting.
+    """
+
+    def __init__(self, fail_silently=False, **kwargs):
+        super(SpoolBackend, self).__init__(fail_silently=fail_silently,
+                                           **kwargs)
+        self.spool = get_spool()
+
+    def send_messages(self, email_messages):
+        """Spool one or more messages.
+
+        :param email_messages: Messages to spool.
+        :returns: the number of messages spooled.
+        """
+
+        spooled = 0
+
+        for message in email_messages:
+            if not message.recipients():
+                continue
+
+            try:
+                self.spool.enqueue(message)
+            except Exception:
+                if not self.fail_silently:
+                    raise
+            else:
+                spooled += 1
+
+        return spooled
+
+
+class BackendHealth(object):
+    """Latency and error tracking with a circuit breaker for a backend.
+
+    The circuit opens after a number of consecutive failures, during which
+    the backend is only used if no other backend is available. Once the
+    circuit has been open for the reset timeout, the backend is tried again
+    and the circuit closes on the first success.
+
+    :ivar sent: Number of successful sends.
+    :ivar errors: Number of failed sends.
+    :ivar latency: Average latency of a send in seconds.
+    :ivar failures: Number of consecutive failures.
+    :ivar opened_at: Time the circuit was opened, or ``None`` if closed.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.latency = None
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def available(self, reset_timeout):
+        """Whether the backend should be used.
+
+        :param reset_timeout:
+            Number of seconds the circuit stays open before the backend is
+            tried again.
+        """
+
+        return self.opened_at is None or \
+            time.time() - self.opened_at >= reset_timeout
+
+    def record(self, latency, success, threshold):
+        """Record a send.
+
+        :param latency: Duration of the send in seconds.
+        :param success: Whether the send succeeded.
+        :param threshold:
+            Number of consecutive failures after which the circuit opens.
+        """
+
+        with self.lock:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+
+            if success:
+                self.sent += 1
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.errors += 1
+                self.failures += 1
+                if self.failures >= threshold:
+                    self.opened_at = time.time()
+
+
+class FailoverBackend(BaseEmailBackend):
+    """E-mail backend distributing messages over several backends.
+
+    The backends are given by the ``PALOMA_FAILOVER_BACKENDS`` setting as a
+    list of ``(backend, weight)`` tuples. Every message is assigned a backend
+    at random in proportion to the weights, and the messages assigned to
+    different backends are sent concurrently. If a backend fails, its
+    messages are sent through the remaining backends by decreasing weight,
+    so messages a backend sent before failing may be delivered twice.
+
+    Backends failing ``PALOMA_FAILOVER_THRESHOLD`` (default 3) times in a row
+    are skipped for ``PALOMA_FAILOVER_RESET_TIMEOUT`` (default 60) seconds.
+    Sends taking longer than ``PALOMA_FAILOVER_SLOW_SEND`` seconds, if set,
+    count as failures for this purpose.
+
+    ``PALOMA_FAILOVER_SLOW_SEND`` is also passed to the backends as their
+    ``timeout``. Backends which support it, such as the SMTP backend from
+    Django 1.7 on, then give up on a hanging provider, although the timeout
+    applies to every network operation rather than the send as a whole.
+    Backends which don't support a timeout can still block for as long as
+    their provider hangs.
+
+    :ivar health: :class:`BackendHealth` by backend, shared by all instances.
+    """
+
+    health = {}
+    health_lock = threading.Lock()
+
+    def __init__(self, fail_silently=False, **kwargs):
+        super(FailoverBackend, self).__init__(fail_silently=fail_silently,
+                                              **kwargs)
+
+        self.backends = getattr(settings, 'PALOMA_FAILOVER_BACKENDS', None)
+        if not self.backends:
+            raise ImproperlyConfigured('the PALOMA_FAILOVER_BACKENDS setting '
+                                       'must be set to use the Paloma '
+                                       'failover backend')
+
+        self.threshold = getattr(settings, 'PALOMA_FAILOVER_THRESHOLD', 3)
+        self.reset_timeout = getattr(settings,
+                                     'PALOMA_FAILOVER_RESET_TIMEOUT',
+                                     60)
+        self.slow_send = getattr(settings, 'PALOMA_FAILOVER_SLOW_SEND', None)
+
+    def get_health(self, backend):
+        """Get the health of a backend.
+
+        :param backend: Backend import path.
+        :returns: the :class:`BackendHealth` of the backend.
+        """
+
+        with self.health_lock:
+            if backend not in self.health:
+                self.health[backend] = BackendHealth()
+            return self.health[backend]
+
+    def choose_backends(self):
+        """Choose the order in which to try the backends for a message.
+
+        :returns:
+            a list of backend import paths, starting with an available
+            backend chosen at random by weight followed by the remaining
+            available backends by decreasing weight, and finally the
+            unavailable backends.
+        """
+
+        available = []
+        unavailable = []
+        for backend, weight in sorted(self.backends,
+                                      key=lambda b: b[1],
+                                      reverse=True):
+            if self.get_health(backend).available(self.reset_timeout):
+                available.append((backend, weight))
+            else:
+                unavailable.append(backend)
+
+        total = sum(weight for backend, weight in available)
+        if total > 0:
+            point = random.random() * total
+            for index, (backend, weight) in enumerate(available):
+                point -= weight
+                if point < 0:
+                    available.insert(0, available.pop(index))
+                    break
+
+        return [backend for backend, weight in available] + unavailable
+
+    def send_through(self, backend, email_messages):
+        """Send messages through a backend, recording its health.
+
+        :param backend: Backend import path.
+        :param email_messages: Messages to send.
+        :returns: the number of messages sent.
+        """
+
+        kwargs = {}
+        if self.slow_send is not None:
+            kwargs['timeout'] = self.slow_send
+
+        start = time.time()
+        try:
+            sent = get_connection(backend, fail_silently=False, **kwargs) \
+                .send_messages(email_messages)
+        except Exception:
+            self.get_health(backend).record(time.time() - start,
+                                            False,
+                                            self.threshold)
+            raise
+
+        latency = time.time() - start
+        self.get_health(backend).record(
+            latency,
+            self.slow_send is None or latency <= self.slow_send,
+            self.threshold
+        )
+
+        return sent or 0
+
+    def send_with_failover(self, backends, email_messages, results):
+        """Send messages through the first backend to succeed.
+
+        :param backends: Backend import paths in the order to try them.
+        :param email_messages: Messages to send.
+        :param results:
+            List to append the number of messages sent or the last exception
+            to.
+        """
+
+        error = None
+        for backend in backends:
+            try:
+                results.append(self.send_through(backend, email_messages))
+                return
+            except Exception as e:
+                error = e
+
+        results.append(error)
+
+    def send_messages(self, email_messages):
+        """Send one or more messages.
+
+        :param email_messages: Messages to send.
+        :returns: the number of messages sent.
+        """
+
+        # Group the messages by the order in which to try the backends.
+        groups = {}
+        for message in email_messages:
+            order = tuple(self.choose_backends())
+            groups.setdefault(order, []).append(message)
+
+        results = []
+        threads = [threading.Thread(target=self.send_with_failover,
+                                    args=(backends, messages, results))
+                   for backends, messages in groups.items()]
+
+        if len(threads) == 1:
+            threads[0].run()
+        else:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        sent = 0
+        for result in results:
+            if isinstance(result, Exception):
+                if not self.fail_silently:
+                    raise result
+            else:
+                sent += result
+
+        return sent
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+
+from paloma.spool import get_spool
+
+
+class Command(BaseCommand):
+    help = 'Sends the e-mail messages in the Paloma spool that are due.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit',
+                    type='int',
+                    dest='limit',
+                    default=None,
+                    help='Maximum number of messages to send.'),
+    )
+
+    def handle(self, *args, **options):
+        connection = get_connection(
+            getattr(settings,
+                    'PALOMA_SPOOL_BACKEND',
+                    'django.core.mail.backends.smtp.EmailBackend')
+        )
+
+        sent, failed = get_spool().drain(connection, limit=options['limit'])
+
+        self.stdout.write('Sent %d message%s, %d failed.\n' % (
+            sent, ('s' if sent != 1 else ''), failed
+        ))
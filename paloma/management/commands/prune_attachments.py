@@ -0,0 +1,34 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from paloma.attachments import get_attachment_store
+
+
+class Command(BaseCommand):
+    help = ('Removes offloaded attachments which have not been stored for '
+            'longer than their download links are valid.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--max-age',
+                    type='int',
+                    dest='max_age',
+                    default=None,
+                    help='Number of seconds to keep attachments for. '
+                         'Defaults to PALOMA_ATTACHMENT_MAX_AGE.'),
+    )
+
+    def handle(self, *args, **options):
+        max_age = options['max_age']
+        if max_age is None:
+            max_age = getattr(settings, 'PALOMA_ATTACHMENT_MAX_AGE', None)
+        if max_age is None:
+            raise CommandError('--max-age must be given if the '
+                               'PALOMA_ATTACHMENT_MAX_AGE setting is not set')
+
+        removed = get_attachment_store().prune(max_age)
+
+        self.stdout.write('Removed %d attachment%s.\n' % (
+            removed, ('s' if removed != 1 else '')
+        ))
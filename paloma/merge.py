@@ -0,0 +1,256 @@
+"""Analysis of templates for merge variable splicing.
+
+:meth:`paloma.TemplateMail.send_many` renders templates once and splices in
+the values of merge variables for every recipient. That only gives the same
+result as a full render if the templates output every merge variable as is,
+which is what :func:`is_mergeable` verifies.
+"""
+
+import re
+
+from django.template import Template
+from django.template.base import (FilterExpression,
+                                  Node,
+                                  NodeList,
+                                  TextNode,
+                                  Token,
+                                  Variable,
+                                  VariableNode)
+from django.template.defaultfilters import register as default_filters
+from django.template.loader import get_template
+from django.template.loader_tags import BlockNode, ExtendsNode
+from django.utils import six
+
+try:
+    from django.template.defaulttags import AutoEscapeControlNode
+except ImportError:
+    AutoEscapeControlNode = None
+
+
+# Filters which leave the value alone, apart from its escaping.
+PASSTHROUGH_FILTERS = (default_filters.filters['safe'],
+                       default_filters.filters['escape'])
+
+
+class NotMergeable(Exception):
+    """Raised while analyzing a template that is not mergeable.
+    """
+
+
+def is_mergeable(template_names, names):
+    """Whether templates output merge variables only as is.
+
+    Merge variables must only be used as plain variable output, optionally
+    with the ``safe`` and ``escape`` filters, outside of any tag other than
+    ``block``, ``autoescape``, ``extends`` and ``include`` with constant
+    template names. Any other use, for example in a filter argument, in the
+    arguments or body of ``if``, ``for`` or ``with``, or by rebinding the
+    name, makes the templates not mergeable. So do tags from outside Django
+    and tags taking the context, which may read merge variables unseen.
+
+    :param template_names: Names of the templates to analyze.
+    :param names: Names of the merge variables.
+    :returns: ``True`` if the templates are mergeable, ``False`` otherwise.
+    """
+
+    pattern = re.compile(r'\b(%s)\b' % (
+        '|'.join(re.escape(name) for name in names)
+    ))
+
+    try:
+        for template_name in template_names:
+            _check_nodelist(_get_nodelist(get_template(template_name)),
+                            set(names),
+                            pattern,
+                            True)
+    except NotMergeable:
+        return False
+
+    return True
+
+
+def _get_nodelist(template):
+    """Get the node list of a template, whichever the template backend.
+    """
+
+    template = getattr(template, 'template', template)
+    if not isinstance(template, Template):
+        raise NotMergeable()
+
+    return template.nodelist
+
+
+def _resolve_template(value):
+    """Get the node list of a constant template reference.
+    """
+
+    if hasattr(value, 'nodelist'):
+        return value.nodelist
+
+    if isinstance(value, FilterExpression) and not value.filters and \
+            not isinstance(value.var, Variable):
+        return _get_nodelist(get_template(value.var))
+
+    raise NotMergeable()
+
+
+def _check_nodelist(nodelist, names, pattern, passthrough):
+    """Check the nodes of a node list.
+
+    :param passthrough:
+        Whether the output of the node list ends up in the rendered template
+        as is, so plain merge variable output is allowed.
+    :raises NotMergeable: if the node list is not mergeable.
+    """
+
+    for node in nodelist:
+        if isinstance(node, TextNode):
+            continue
+
+        if isinstance(node, VariableNode):
+            _check_variable_node(node, names, pattern, passthrough)
+            continue
+
+        if not type(node).__module__.startswith('django.') or \
+                getattr(node, 'takes_context', False) or \
+                type(node).__name__ == 'DebugNode':
+            raise NotMergeable()
+
+        if isinstance(node, ExtendsNode):
+            _check_references(node.parent_name, pattern, set())
+            _check_nodelist(_resolve_template(node.parent_name),
+                            names,
+                            pattern,
+                            passthrough)
+            _check_nodelist(node.nodelist, names, pattern, passthrough)
+            continue
+
+        if type(node).__name__ in ('IncludeNode', 'ConstantIncludeNode'):
+            _check_node_references(node, pattern)
+
+            # Isolated includes can't see the merge variables.
+            if getattr(node, 'isolated_context', False):
+                continue
+
+            template = getattr(node, 'template', None)
+            if template is None:
+                template = getattr(node, 'template_name', None)
+            _check_nodelist(_resolve_template(template),
+                            names,
+                            pattern,
+                            passthrough)
+            continue
+
+        # Any other tag must not refer to merge variables, and its output may
+        # differ from that of its body, unless it is known to pass it on.
+        _check_node_references(node, pattern)
+
+        child_passthrough = passthrough and (
+            isinstance(node, BlockNode) or
+            (AutoEscapeControlNode is not None and
+             isinstance(node, AutoEscapeControlNode))
+        )
+        for child_nodelist in _get_child_nodelists(node):
+            _check_nodelist(child_nodelist,
+                            names,
+                            pattern,
+                            child_passthrough)
+
+
+def _check_variable_node(node, names, pattern, passthrough):
+    """Check a variable output node.
+
+    :raises NotMergeable: if the node is not mergeable.
+    """
+
+    filter_expression = node.filter_expression
+    var = filter_expression.var
+
+    for func, args in filter_expression.filters:
+        _check_references(args, pattern, set())
+
+    if not isinstance(var, Variable) or var.lookups is None or \
+            var.lookups[0] not in names:
+        return
+
+    if not passthrough or len(var.lookups) != 1:
+        raise NotMergeable()
+
+    for func, args in filter_expression.filters:
+        if func not in PASSTHROUGH_FILTERS:
+            raise NotMergeable()
+
+
+def _get_child_nodelists(node):
+    """Get the node lists nested in a node.
+    """
+
+    nodelists = []
+    for attr in node.child_nodelists:
+        nodelist = getattr(node, attr, None)
+        if nodelist:
+            nodelists.append(nodelist)
+
+    def collect(value):
+        if isinstance(value, NodeList):
+            nodelists.append(value)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                collect(item)
+
+    for value in vars(node).values():
+        collect(value)
+
+    return nodelists
+
+
+def _check_node_references(node, pattern):
+    """Check that the arguments of a node do not refer to merge variables.
+
+    :raises NotMergeable: if the node refers to a merge variable.
+    """
+
+    seen = set()
+    for value in vars(node).values():
+        _check_references(value, pattern, seen)
+
+
+def _check_references(value, pattern, seen):
+    """Check that a value does not refer to any merge variable.
+
+    Recursively inspects variables, filter expressions, tokens, strings,
+    containers and the attributes of template objects, except for nodes,
+    which are checked separately.
+
+    :raises NotMergeable: if the value refers to a merge variable.
+    """
+
+    if id(value) in seen:
+        return
+    seen.add(id(value))
+
+    if isinstance(value, (Node, NodeList, Template)):
+        return
+
+    if isinstance(value, six.string_types):
+        if pattern.search(value):
+            raise NotMergeable()
+    elif isinstance(value, Variable):
+        _check_references(value.var, pattern, seen)
+    elif isinstance(value, FilterExpression):
+        _check_references(value.var, pattern, seen)
+        for func, args in value.filters:
+            _check_references(args, pattern, seen)
+    elif isinstance(value, Token):
+        _check_references(value.contents, pattern, seen)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _check_references(key, pattern, seen)
+            _check_references(item, pattern, seen)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            _check_references(item, pattern, seen)
+    elif type(value).__module__.startswith('django.template') and \
+            hasattr(value, '__dict__'):
+        for item in vars(value).values():
+            _check_references(item, pattern, seen)
@@ -0,0 +1,218 @@
+"""File-backed spool for outgoing e-mail messages.
+
+Messages are written to the spool by :class:`paloma.backends.SpoolBackend`
+and sent later by the ``drain_spool`` management command, so callers of
+:meth:`paloma.Mail.send` never wait on a slow mail server.
+"""
+
+import calendar
+import copy
+import errno
+import os
+import time
+import uuid
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# fcntl is not available on Windows, where messages can still be spooled,
+# but overlapping drains are not locked out.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.timezone import get_default_timezone, is_aware, make_aware
+
+
+class Spool(object):
+    """Spool of outgoing e-mail messages.
+
+    Every message is pickled to a file of its own in the spool directory,
+    named by the time the message is due to be sent, so the sorted directory
+    listing orders the messages by due time. Files are written under a
+    temporary name and renamed into place, so a reader never sees a
+    partially written message, and the spool is picked up as it was after a
+    restart.
+
+    :ivar path: Spool directory.
+    """
+
+    suffix = '.msg'
+
+    def __init__(self, path):
+        """Initialize a spool.
+
+        :param path:
+            Spool directory. The directory is created if it does not exist.
+        """
+
+        self.path = path
+
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def enqueue(self, message, send_at=None):
+        """Add a message to the spool.
+
+        :param message: :class:`django.core.mail.EmailMessage` to spool.
+        :param send_at:
+            :class:`datetime.datetime` the message is due to be sent at. If
+            ``None``, the message is due right away. Naive times are
+            interpreted in the default time zone if ``USE_TZ`` is set, and
+            as local time otherwise.
+        :returns: the key of the spooled message.
+        """
+
+        # Connections can't be pickled, and the drainer supplies its own.
+        message = copy.copy(message)
+        message.connection = None
+
+        key = '%020d-%s%s' % (int(timestamp(send_at) * 1000000),
+                              uuid.uuid4().hex,
+                              self.suffix)
+        temp_path = os.path.join(self.path, '.%s.tmp' % (key))
+
+        with open(temp_path, 'wb') as spool_file:
+            pickle.dump(message, spool_file, pickle.HIGHEST_PROTOCOL)
+            spool_file.flush()
+            os.fsync(spool_file.fileno())
+
+        os.rename(temp_path, os.path.join(self.path, key))
+
+        return key
+
+    def keys(self):
+        """Keys of the spooled messages in the order they are due.
+
+        :returns: a list of keys.
+        """
+
+        return sorted(name for name in os.listdir(self.path)
+                      if name.endswith(self.suffix))
+
+    def due_keys(self, now=None):
+        """Keys of the spooled messages that are due in the order they are due.
+
+        :param now:
+            :class:`datetime.datetime` to determine what is due by. If
+            ``None``, the current time is used. Default ``None``.
+        :returns: a list of keys.
+        """
+
+        cutoff = '%020d' % (int(timestamp(now) * 1000000))
+
+        return [key for key in self.keys() if key[:20] <= cutoff]
+
+    def load(self, key):
+        """Load a spooled message.
+
+        :param key: Key of the message.
+        :returns: the :class:`django.core.mail.EmailMessage`.
+        """
+
+        with open(os.path.join(self.path, key), 'rb') as spool_file:
+            return pickle.load(spool_file)
+
+    def remove(self, key):
+        """Remove a message from the spool.
+
+        :param key: Key of the message.
+        """
+
+        os.remove(os.path.join(self.path, key))
+
+    def drain(self, connection, limit=None):
+        """Send the spooled messages.
+
+        Messages that are due are sent in the order they are due and removed
+        once sent. Messages that fail to send are left in the spool to be
+        retried by the next drain.
+
+        A drain holds an exclusive lock on the spool for as long as it runs,
+        so that overlapping drains never send a message twice. If the spool
+        is already being drained, nothing is sent. The lock is released by
+        the operating system if the draining process dies. There is no lock on
+        platforms without :mod:`fcntl`, such as Windows.
+
+        :param connection: E-mail backend to send the messages through.
+        :param limit:
+            Maximum number of messages to send. If ``None``, all messages
+            that are due are sent. Default ``None``.
+        :returns: a tuple of the number of messages sent and failed.
+        """
+
+        sent = 0
+        failed = 0
+
+        with open(os.path.join(self.path, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as e:
+                    if e.errno not in (errno.EACCES, errno.EAGAIN):
+                        raise
+                    return sent, failed
+
+            connection.open()
+            try:
+                for key in self.due_keys()[:limit]:
+                    try:
+                        connection.send_messages([self.load(key)])
+                    except Exception:
+                        failed += 1
+                        continue
+
+                    self.remove(key)
+                    sent += 1
+            finally:
+                connection.close()
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        return sent, failed
+
+
+def timestamp(value=None):
+    """Get the POSIX timestamp of a time.
+
+    :param value:
+        :class:`datetime.datetime` to get the timestamp of. Naive times are
+        interpreted in the default time zone if ``USE_TZ`` is set, and as
+        local time otherwise. If ``None``, the current time is used.
+    :returns: the timestamp as a float.
+    """
+
+    if value is None:
+        return time.time()
+
+    if not is_aware(value) and getattr(settings, 'USE_TZ', False):
+        value = make_aware(value, get_default_timezone())
+
+    if is_aware(value):
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+
+    return seconds + value.microsecond / 1000000.0
+
+
+def get_spool():
+    """Get the spool configured by the ``PALOMA_SPOOL_DIR`` setting.
+
+    :returns: a :class:`Spool`.
+    """
+
+    path = getattr(settings, 'PALOMA_SPOOL_DIR', None)
+    if not path:
+        raise ImproperlyConfigured('the PALOMA_SPOOL_DIR setting must be set '
+                                   'to use the Paloma spool')
+
+    return Spool(path)
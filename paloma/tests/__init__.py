@@ -1 +1,4 @@
+from .attachments import *
+from .backends import *
 from .mail import *
+from .spool import *
@@ -0,0 +1,255 @@
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from paloma import Mail
+from paloma.attachments import (AttachmentStore,
+                                encoded_size,
+                                get_attachment_url,
+                                load_attachment_token)
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test.utils import override_settings
+from django.utils.six.moves.urllib.parse import unquote
+from .testcase import TestCase
+
+
+class AttachmentStoreTestCase(TestCase):
+    """Test case for :class:`AttachmentStore`.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = AttachmentStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_save__deduplicates(self):
+        """AttachmentStore().save(..) stores identical contents once
+        """
+
+        digest = self.store.save(b'contents')
+        self.assertEqual(self.store.save(b'contents'), digest)
+        self.assertNotEqual(self.store.save(b'other contents'), digest)
+
+        self.assertEqual(len(os.listdir(self.path)), 2)
+        with open(self.store.get_path(digest), 'rb') as attachment_file:
+            self.assertEqual(attachment_file.read(), b'contents')
+
+    def test_prune(self):
+        """AttachmentStore().prune(..) removes attachments stored long ago
+        """
+
+        old = self.store.save(b'old contents')
+        new = self.store.save(b'new contents')
+        temp_path = os.path.join(self.path, '.%s.tmp' % (old))
+        open(temp_path, 'wb').close()
+
+        past = time.time() - 100
+        os.utime(self.store.get_path(old), (past, past))
+        os.utime(self.store.get_path(new), (past, past))
+        os.utime(temp_path, (past, past))
+
+        # Storing an attachment again keeps it.
+        self.store.save(b'new contents')
+
+        self.assertEqual(self.store.prune(50), 1)
+        self.assertEqual(os.listdir(self.path), [new])
+        self.assertEqual(self.store.prune(50), 0)
+
+    def test_prune_attachments(self):
+        """prune_attachments prunes by PALOMA_ATTACHMENT_MAX_AGE or --max-age
+        """
+
+        digest = self.store.save(b'contents')
+        past = time.time() - 100
+        os.utime(self.store.get_path(digest), (past, past))
+
+        with override_settings(PALOMA_ATTACHMENT_DIR=self.path,
+                               PALOMA_ATTACHMENT_MAX_AGE=None):
+            self.assertRaises(CommandError, call_command, 'prune_attachments')
+
+            call_command('prune_attachments', max_age=200)
+            self.assertEqual(os.listdir(self.path), [digest])
+
+            with override_settings(PALOMA_ATTACHMENT_MAX_AGE=50):
+                call_command('prune_attachments')
+            self.assertEqual(os.listdir(self.path), [])
+
+    def test_encoded_size(self):
+        """encoded_size(..) includes base64 overhead and line breaks
+        """
+
+        self.assertEqual(encoded_size(b''), 0)
+        self.assertEqual(encoded_size(b'a'), 4)
+        self.assertEqual(encoded_size(b'a' * 57), 78)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='default@example.com',
+                   DEFAULT_FROM_NAME='Default sender',
+                   PALOMA_ATTACHMENT_BASE_URL='http://example.com',
+                   ROOT_URLCONF='paloma.urls')
+class CompactionTestCase(TestCase):
+    """Test case for :meth:`Mail.compact`.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def send(self, attachment_size_limit, html_body=None, test_mail=None):
+        if test_mail is None:
+            class TestMail(Mail):
+                subject = 'Subject of the e-mail'
+
+            test_mail = TestMail(attachment_size_limit=attachment_size_limit)
+            test_mail.attachments['large.bin'] = (b'x' * 3000, None)
+            test_mail.attachments['small.txt'] = (b'y' * 30, 'text/plain')
+
+        with override_settings(PALOMA_ATTACHMENT_DIR=self.path):
+            with self.assertMailsSent(1):
+                test_mail.send('test@example.com',
+                               'Body of the e-mail',
+                               html_body)
+
+        return mail.outbox[-1]
+
+    def test_send__within_limit(self):
+        """Mail(<within size limit>).send(..) attaches everything
+        """
+
+        message = self.send(10000)
+
+        self.assertEqual(message.body, 'Body of the e-mail')
+        self.assertEqual(sorted(a[0] for a in message.attachments),
+                         ['large.bin', 'small.txt'])
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_send__offloads_largest_attachments(self):
+        """Mail(<over size limit>).send(..) offloads the largest attachments
+        """
+
+        message = self.send(1000, '<html><body><p>Body</p></body></html>')
+
+        self.assertEqual([a[0] for a in message.attachments], ['small.txt'])
+        self.assertEqual(len(os.listdir(self.path)), 1)
+
+        self.assertTrue(message.body.startswith(
+            u'Body of the e-mail\n\nAttachments:\n\nlarge.bin: '
+            u'http://example.com/attachments/'
+        ))
+
+        html_body = message.alternatives[0][0]
+        self.assertTrue(html_body.startswith(
+            u'<html><body><p>Body</p><p>Attachments:</p><ul><li><a href="'
+            u'http://example.com/attachments/'
+        ))
+        self.assertTrue(html_body.endswith(
+            u'">large.bin</a></li></ul></body></html>'
+        ))
+
+    def test_send__deduplicates_offloaded_attachments(self):
+        """Mail(<over size limit>).send(..) stores identical attachments once
+        """
+
+        first = self.send(1000)
+        second = self.send(1000)
+
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        self.assertEqual(
+            load_attachment_token(self.get_token(first.body))[0],
+            load_attachment_token(self.get_token(second.body))[0]
+        )
+
+    def test_send__reuses_offloaded_attachment_links(self):
+        """Mail(<over size limit>).send(..) stores and signs attachments once
+        """
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+            attachment_size_limit = 1000
+
+        test_mail = TestMail()
+        test_mail.attachments['large.bin'] = (b'x' * 3000, None)
+
+        first = self.send(None, test_mail=test_mail)
+        for name in os.listdir(self.path):
+            os.remove(os.path.join(self.path, name))
+        second = self.send(None, test_mail=test_mail)
+
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(second.body, first.body)
+
+        # Changed contents are offloaded again.
+        test_mail.attachments['large.bin'] = (b'z' * 3000, None)
+        third = self.send(None, test_mail=test_mail)
+
+        self.assertEqual(len(os.listdir(self.path)), 1)
+        self.assertNotEqual(third.body, first.body)
+
+    def get_token(self, body):
+        return unquote(re.search(r'/attachments/([^/]+)/', body).group(1))
+
+    def test_send__over_limit_without_attachments(self):
+        """Mail(<over size limit>).send(..) without attachments adds no links
+        """
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+            attachment_size_limit = 10
+
+        html_body = '<html><body><p>Body</p></body></html>'
+        with override_settings(PALOMA_ATTACHMENT_DIR=self.path):
+            with self.assertMailsSent(1):
+                TestMail().send('test@example.com',
+                                'Body of the e-mail',
+                                html_body)
+
+        self.assertEqual(mail.outbox[-1].body, 'Body of the e-mail')
+        self.assertEqual(mail.outbox[-1].alternatives[0][0], html_body)
+
+    def test_get_attachment_url__requires_base_url(self):
+        """get_attachment_url(..) requires PALOMA_ATTACHMENT_BASE_URL
+        """
+
+        with override_settings(PALOMA_ATTACHMENT_BASE_URL=None):
+            self.assertRaises(ImproperlyConfigured,
+                              get_attachment_url,
+                              'digest',
+                              'file.txt')
+
+    def test_attachment__serves_offloaded_attachment(self):
+        """attachment(..) serves offloaded attachments with a valid token
+        """
+
+        with override_settings(PALOMA_ATTACHMENT_DIR=self.path):
+            url = get_attachment_url(AttachmentStore(self.path)
+                                     .save(b'contents'),
+                                     'file.txt')
+            path = re.sub(r'^http://example\.com', '', url)
+
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'text/plain')
+            self.assertEqual(response['Content-Disposition'],
+                             'attachment; filename="file.txt"')
+            self.assertEqual(b''.join(getattr(response,
+                                              'streaming_content',
+                                              response)),
+                             b'contents')
+
+            response = self.client.get(path.replace('/attachments/',
+                                                    '/attachments/x'))
+            self.assertEqual(response.status_code, 404)
+
+
+__all__ = (
+    'AttachmentStoreTestCase',
+    'CompactionTestCase',
+)
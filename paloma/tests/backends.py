@@ -0,0 +1,259 @@
+import threading
+import time
+
+from paloma import Mail
+from paloma.backends import FailoverBackend
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.mail.backends.locmem import EmailBackend as LocmemBackend
+from django.test.utils import override_settings
+from .testcase import TestCase
+
+
+LOCMEM_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+FAILING_BACKEND = 'paloma.tests.backends.FailingBackend'
+SLOW_BACKEND = 'paloma.tests.backends.SlowBackend'
+FIRST_BACKEND = 'paloma.tests.backends.FirstRecordingBackend'
+SECOND_BACKEND = 'paloma.tests.backends.SecondRecordingBackend'
+
+
+class FailingBackend(BaseEmailBackend):
+    """E-mail backend failing to send any message.
+    """
+
+    def send_messages(self, email_messages):
+        raise IOError('connection refused')
+
+
+class SlowBackend(LocmemBackend):
+    """In-memory e-mail backend taking its time to send messages.
+    """
+
+    def send_messages(self, email_messages):
+        time.sleep(0.05)
+        return super(SlowBackend, self).send_messages(email_messages)
+
+
+class RecordingBackend(LocmemBackend):
+    """In-memory e-mail backend recording its sends.
+
+    :ivar sends:
+        List of tuples of the sending thread and the messages sent.
+    :ivar timeouts: List of the timeouts the backend was created with.
+    """
+
+    sends = None
+    timeouts = None
+
+    def __init__(self, timeout=None, **kwargs):
+        super(RecordingBackend, self).__init__(**kwargs)
+        type(self).timeouts.append(timeout)
+
+    def send_messages(self, email_messages):
+        type(self).sends.append((threading.current_thread(),
+                                 list(email_messages)))
+        return super(RecordingBackend, self).send_messages(email_messages)
+
+
+class FirstRecordingBackend(RecordingBackend):
+    sends = []
+    timeouts = []
+
+
+class SecondRecordingBackend(RecordingBackend):
+    sends = []
+    timeouts = []
+
+
+@override_settings(DEFAULT_FROM_EMAIL='default@example.com',
+                   DEFAULT_FROM_NAME='Default sender',
+                   EMAIL_BACKEND='paloma.backends.FailoverBackend')
+class FailoverBackendTestCase(TestCase):
+    """Test case for :class:`FailoverBackend`.
+    """
+
+    def setUp(self):
+        FailoverBackend.health.clear()
+        for backend in (FirstRecordingBackend, SecondRecordingBackend):
+            del backend.sends[:]
+            del backend.timeouts[:]
+
+    def messages(self, count):
+        return [EmailMessage('Subject of the e-mail',
+                             'Body of the e-mail %d' % (i),
+                             'default@example.com',
+                             ['test@example.com'])
+                for i in range(count)]
+
+    def send(self, count=1):
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+
+        for i in range(count):
+            TestMail().send('test@example.com', 'Body of the e-mail')
+
+    def test_init__requires_setting(self):
+        """FailoverBackend() requires the PALOMA_FAILOVER_BACKENDS setting
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=None):
+            self.assertRaises(ImproperlyConfigured, FailoverBackend)
+
+    def test_send_messages__distributes_by_weight(self):
+        """FailoverBackend().send_messages(..) only uses weighted backends
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (LOCMEM_BACKEND, 1),
+                (FAILING_BACKEND, 0),
+        ]):
+            with self.assertMailsSent(5):
+                self.send(5)
+
+        self.assertEqual(FailoverBackend.health[LOCMEM_BACKEND].sent, 5)
+        self.assertEqual(FailoverBackend.health[FAILING_BACKEND].errors, 0)
+
+    def test_send_messages__sends_groups_concurrently(self):
+        """FailoverBackend().send_messages(..) sends groups in threads
+        """
+
+        messages = self.messages(50)
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FIRST_BACKEND, 1),
+                (SECOND_BACKEND, 1),
+        ]):
+            with self.assertMailsSent(50):
+                self.assertEqual(FailoverBackend().send_messages(messages),
+                                 50)
+
+        first = FirstRecordingBackend.sends
+        second = SecondRecordingBackend.sends
+        self.assertEqual(len(first), 1)
+        self.assertEqual(len(second), 1)
+
+        # Every message went to exactly one backend.
+        self.assertEqual(sorted(m.body for m in first[0][1] + second[0][1]),
+                         sorted(m.body for m in messages))
+
+        main_thread = threading.current_thread()
+        self.assertNotEqual(first[0][0], main_thread)
+        self.assertNotEqual(second[0][0], main_thread)
+        self.assertNotEqual(first[0][0], second[0][0])
+
+    def test_send_messages__fails_over_concurrent_group(self):
+        """FailoverBackend().send_messages(..) fails over a failed group
+        """
+
+        messages = self.messages(50)
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FAILING_BACKEND, 1),
+                (FIRST_BACKEND, 1),
+        ]):
+            with self.assertMailsSent(50):
+                self.assertEqual(FailoverBackend().send_messages(messages),
+                                 50)
+
+        # The first backend sent its own group, and then the failed group.
+        sends = FirstRecordingBackend.sends
+        self.assertEqual(len(sends), 2)
+        self.assertEqual(sorted(m.body for t, sent in sends for m in sent),
+                         sorted(m.body for m in messages))
+        self.assertEqual(FailoverBackend.health[FAILING_BACKEND].errors, 1)
+        self.assertEqual(FailoverBackend.health[FIRST_BACKEND].sent, 2)
+
+    def test_send_messages__passes_timeout(self):
+        """FailoverBackend().send_messages(..) passes the slow send timeout
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FIRST_BACKEND, 1),
+        ]):
+            FailoverBackend().send_messages(self.messages(1))
+
+            with override_settings(PALOMA_FAILOVER_SLOW_SEND=5):
+                FailoverBackend().send_messages(self.messages(1))
+
+        self.assertEqual(FirstRecordingBackend.timeouts, [None, 5])
+
+    def test_send_messages__fails_over(self):
+        """FailoverBackend().send_messages(..) fails over to the next backend
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FAILING_BACKEND, 1),
+                (LOCMEM_BACKEND, 0),
+        ]):
+            with self.assertMailsSent(1):
+                self.send()
+
+        self.assertEqual(FailoverBackend.health[FAILING_BACKEND].errors, 1)
+        self.assertEqual(FailoverBackend.health[LOCMEM_BACKEND].sent, 1)
+
+    def test_send_messages__opens_circuit(self):
+        """FailoverBackend().send_messages(..) skips failing backends
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FAILING_BACKEND, 1),
+                (LOCMEM_BACKEND, 0),
+        ], PALOMA_FAILOVER_THRESHOLD=2):
+            with self.assertMailsSent(5):
+                self.send(5)
+
+        self.assertEqual(FailoverBackend.health[FAILING_BACKEND].errors, 2)
+        self.assertEqual(FailoverBackend.health[LOCMEM_BACKEND].sent, 5)
+
+    def test_send_messages__retries_after_reset_timeout(self):
+        """FailoverBackend().send_messages(..) retries after the reset timeout
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FAILING_BACKEND, 1),
+                (LOCMEM_BACKEND, 0),
+        ], PALOMA_FAILOVER_THRESHOLD=1, PALOMA_FAILOVER_RESET_TIMEOUT=0):
+            with self.assertMailsSent(3):
+                self.send(3)
+
+        self.assertEqual(FailoverBackend.health[FAILING_BACKEND].errors, 3)
+
+    def test_send_messages__slow_sends_count_as_failures(self):
+        """FailoverBackend().send_messages(..) skips slow backends
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (SLOW_BACKEND, 1),
+                (LOCMEM_BACKEND, 0),
+        ], PALOMA_FAILOVER_THRESHOLD=1, PALOMA_FAILOVER_SLOW_SEND=0.01):
+            with self.assertMailsSent(2):
+                self.send(2)
+
+        health = FailoverBackend.health[SLOW_BACKEND]
+        self.assertEqual(health.errors, 1)
+        self.assertTrue(health.latency >= 0.05)
+        self.assertEqual(FailoverBackend.health[LOCMEM_BACKEND].sent, 1)
+
+    def test_send_messages__raises_when_all_backends_fail(self):
+        """FailoverBackend().send_messages(..) raises if all backends fail
+        """
+
+        with override_settings(PALOMA_FAILOVER_BACKENDS=[
+                (FAILING_BACKEND, 1),
+        ]):
+            with self.assertMailsSent(0):
+                self.assertRaises(IOError, self.send)
+
+            message = EmailMessage('Subject of the e-mail',
+                                   'Body of the e-mail',
+                                   'default@example.com',
+                                   ['test@example.com'])
+            backend = FailoverBackend(fail_silently=True)
+            with self.assertMailsSent(0):
+                self.assertEqual(backend.send_messages([message]), 0)
+
+
+__all__ = (
+    'FailoverBackendTestCase',
+)
@@ -1,6 +1,15 @@
 import os
+import shutil
+import tempfile
+from datetime import date, datetime, time, timedelta
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
 
 from paloma import Mail, TemplateMail
+from paloma.spool import Spool
 from django.core import mail
 from django.test.utils import override_settings
 from .testcase import TestCase
@@ -160,6 +169,96 @@ class MailTestCase(TestCase):
         self.assertEqual(message.cc, ['cc@example.com'])
         self.assertEqual(message.bcc, ['bcc@example.com'])
 
+    def test_send__spools_with_send_at(self):
+        """Mail().send(.., send_at=<time>) spools the e-mail until due
+        """
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+
+        path = tempfile.mkdtemp()
+        try:
+            send_at = datetime.now() + timedelta(hours=1)
+            with override_settings(PALOMA_SPOOL_DIR=path):
+                with self.assertMailsSent(0):
+                    TestMail().send('test@example.com',
+                                    'Body of the e-mail',
+                                    send_at=send_at)
+
+            spool = Spool(path)
+            self.assertEqual(len(spool.keys()), 1)
+            self.assertEqual(spool.due_keys(), [])
+            self.assertEqual(spool.due_keys(send_at), spool.keys())
+            self.assertSimple(spool.load(spool.keys()[0]))
+        finally:
+            shutil.rmtree(path)
+
+    def test_send__sends_within_delivery_window(self):
+        """Mail(<open delivery window>).send(..) sends right away
+        """
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+            delivery_window = (time(0), time.max)
+
+        self.assertEqual(TestMail().get_send_at(), None)
+
+        with self.assertMailsSent(1):
+            TestMail().send('test@example.com', 'Body of the e-mail')
+        self.assertSimple(mail.outbox[-1])
+
+    def test_get_send_at__within_next_delivery_window(self):
+        """Mail(<closed delivery window>).get_send_at() is within the window
+        """
+
+        now = datetime.now()
+        start = now + timedelta(hours=2)
+        end = now + timedelta(hours=3)
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+            delivery_window = (start.time(), end.time())
+
+        for i in range(10):
+            send_at = TestMail().get_send_at()
+            self.assertTrue(start <= send_at <= end)
+
+    def test_get_send_at__across_daylight_saving_time_change(self):
+        """Mail().get_send_at(..) uses the UTC offset of the time picked
+        """
+
+        if pytz is None:
+            return
+
+        timezone = pytz.timezone('Europe/Copenhagen')
+        now = timezone.localize(datetime(2014, 10, 25, 12))
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+            delivery_window = (time(0), time(6))
+
+        for i in range(20):
+            send_at = TestMail().get_send_at(timezone, now)
+            local_time = send_at.replace(tzinfo=None)
+            self.assertTrue(datetime(2014, 10, 26, 0) <= local_time <=
+                            datetime(2014, 10, 26, 6))
+            self.assertEqual(send_at, timezone.normalize(send_at))
+            self.assertEqual(send_at.utcoffset(),
+                             timezone.localize(local_time).utcoffset())
+
+    def test_init__rejects_empty_delivery_window(self):
+        """Mail(delivery_window=<empty>) raises ValueError
+        """
+
+        self.assertRaises(ValueError,
+                          Mail,
+                          delivery_window=(time(6), time(6)))
+
+        class TestMail(Mail):
+            delivery_window = (time(6), time(6))
+
+        self.assertRaises(ValueError, TestMail)
+
 
 @override_settings(DEFAULT_FROM_EMAIL='default@example.com',
                    DEFAULT_FROM_NAME='Default sender',
@@ -297,6 +396,148 @@ class TemplateMailTestCase(TestCase):
             html_body=html_body_format % ('in local context')
         )
 
+    def test_send_many__merge_variables(self):
+        """TemplateMail(<merge variables>).send_many(..) renders once
+        """
+
+        class TestMail(TemplateMail):
+            subject = 'Subject of the e-mail'
+            subject_template_name = 'test_mail_subject.txt'
+            text_template_name = 'test_mail.txt'
+            html_template_name = 'test_mail.html'
+            merge_variables = ('a', )
+
+            rendered = 0
+
+            def render_template(self, template_name, context):
+                self.rendered += 1
+                return super(TestMail, self).render_template(template_name,
+                                                             context)
+
+        recipients = [
+            ('first@example.com', {'a': 'first'}),
+            ('second@example.com', {'a': '<b>second</b> & more'}),
+        ]
+
+        # Send individually for reference.
+        with self.assertMailsSent(2):
+            for to, context in recipients:
+                TestMail().send(to, context)
+        expected = mail.outbox[-2:]
+
+        test_mail = TestMail()
+        with self.assertMailsSent(2):
+            test_mail.send_many(recipients)
+        self.assertEqual(test_mail.rendered, 3)
+
+        for sent, expected_sent in zip(mail.outbox[-2:], expected):
+            self.assertEqual(sent.to, expected_sent.to)
+            self.assertEqual(sent.subject, expected_sent.subject)
+            self.assertEqual(sent.body, expected_sent.body)
+            self.assertEqual(sent.alternatives, expected_sent.alternatives)
+
+        self.assertEqual(
+            mail.outbox[-1].alternatives[0][0].splitlines()[3].strip(),
+            u'<p>Has variable &lt;b&gt;second&lt;/b&gt; &amp; more.</p>'
+        )
+
+    def test_send_many__merge_variables_with_filter(self):
+        """TemplateMail(<filtered merge variables>).send_many(..) renders all
+        """
+
+        class TestMail(TemplateMail):
+            subject = 'Subject of the e-mail'
+            text_template_name = 'test_mail_filtered.txt'
+            merge_variables = ('a', )
+
+        with self.assertMailsSent(2):
+            TestMail().send_many([('first@example.com', {'a': 'first'}),
+                                  ('second@example.com', {'a': 'second'})])
+
+        self.assertSimple(mail.outbox[-2],
+                          body=u'Has variable FIRST.',
+                          to='first@example.com')
+        self.assertSimple(mail.outbox[-1],
+                          body=u'Has variable SECOND.',
+                          to='second@example.com')
+
+    def test_send_many__merge_variables_used_otherwise(self):
+        """TemplateMail(<merge variables used otherwise>).send_many(..)
+        """
+
+        recipients = [
+            ('first@example.com', {'name': ''}),
+            ('second@example.com', {'name': 'bob'}),
+            ('third@example.com', {'name': '<b>bob</b>'}),
+            ('fourth@example.com', {'name': 1234567}),
+            ('fifth@example.com', {'name': date(2020, 1, 2)}),
+            ('sixth@example.com', {'name': lambda: 'called'}),
+            ('seventh@example.com', {}),
+        ]
+        strings = 3
+
+        for template_name, spliced in (
+                ('test_merge_default.txt', False),
+                ('test_merge_if.txt', False),
+                ('test_merge_truncatechars.txt', False),
+                ('test_merge_length.txt', False),
+                ('test_merge_for.txt', False),
+                ('test_merge_with.txt', False),
+                ('test_merge_autoescape.txt', True)):
+
+            class TestMail(TemplateMail):
+                subject = 'Subject of the e-mail'
+                text_template_name = template_name
+                merge_variables = ('name', )
+
+                rendered = 0
+
+                def render_template(self, template_name, context):
+                    self.rendered += 1
+                    return super(TestMail, self).render_template(
+                        template_name,
+                        context
+                    )
+
+            with override_settings(USE_L10N=True,
+                                   USE_THOUSAND_SEPARATOR=True):
+                # Send individually for reference.
+                with self.assertMailsSent(len(recipients)):
+                    for to, context in recipients:
+                        TestMail().send(to, context)
+                expected = [m.body for m in mail.outbox[-len(recipients):]]
+
+                test_mail = TestMail()
+                with self.assertMailsSent(len(recipients)):
+                    test_mail.send_many(recipients)
+
+            self.assertEqual([m.body for m in mail.outbox[-len(recipients):]],
+                             expected)
+            self.assertEqual(test_mail.rendered,
+                             (1 + len(recipients) - strings) if spliced
+                             else len(recipients))
+
+    def test_send_many__without_merge_variables(self):
+        """TemplateMail().send_many(..) renders for every recipient
+        """
+
+        class TestMail(TemplateMail):
+            subject = 'Subject of the e-mail'
+            text_template_name = 'test_mail.txt'
+
+        with self.assertMailsSent(2):
+            TestMail(context={'a': 'in class context'}).send_many([
+                ('first@example.com', None),
+                ('second@example.com', {'a': 'in local context'}),
+            ])
+
+        self.assertSimple(mail.outbox[-2],
+                          body=u'Test body.\n\nHas variable in class context.',
+                          to='first@example.com')
+        self.assertSimple(mail.outbox[-1],
+                          body=u'Test body.\n\nHas variable in local context.',
+                          to='second@example.com')
+
 
 __all__ = (
     'MailTestCase',
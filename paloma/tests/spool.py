@@ -0,0 +1,249 @@
+import fcntl
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from paloma import Mail
+from paloma.backends import SpoolBackend
+from paloma.spool import Spool, get_spool
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage, get_connection
+from django.core.management import call_command
+from django.utils.six import StringIO
+from django.test.utils import override_settings
+from .backends import FailingBackend
+from .testcase import TestCase
+
+
+class SpoolTestCase(TestCase):
+    """Test case for :class:`Spool`.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.spool = Spool(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def message(self, subject='Subject of the e-mail'):
+        return EmailMessage(subject,
+                            'Body of the e-mail',
+                            'default@example.com',
+                            ['test@example.com'])
+
+    def test_init__creates_directory(self):
+        """Spool(..) creates the spool directory
+        """
+
+        path = os.path.join(self.path, 'spool')
+        Spool(path)
+        self.assertTrue(os.path.isdir(path))
+
+    def test_enqueue__persists_message(self):
+        """Spool().enqueue(..) persists the message across spool instances
+        """
+
+        key = self.spool.enqueue(self.message())
+
+        spool = Spool(self.path)
+        self.assertEqual(spool.keys(), [key])
+        message = spool.load(key)
+        self.assertEqual(message.subject, 'Subject of the e-mail')
+        self.assertEqual(message.to, ['test@example.com'])
+
+    def test_keys__in_spooled_order(self):
+        """Spool().keys() returns the keys in the order they were spooled
+        """
+
+        keys = [self.spool.enqueue(self.message()) for i in range(5)]
+        self.assertEqual(self.spool.keys(), keys)
+
+    def test_due_keys__in_due_order(self):
+        """Spool().due_keys(..) returns the due keys in the order they are due
+        """
+
+        now = datetime.now()
+        second = self.spool.enqueue(self.message(),
+                                    now - timedelta(minutes=1))
+        first = self.spool.enqueue(self.message(), now - timedelta(hours=1))
+        later = self.spool.enqueue(self.message(), now + timedelta(hours=1))
+
+        self.assertEqual(self.spool.due_keys(), [first, second])
+        self.assertEqual(self.spool.due_keys(now + timedelta(hours=2)),
+                         [first, second, later])
+
+    def test_drain__sends_and_removes_messages(self):
+        """Spool().drain(..) sends the messages and removes them
+        """
+
+        self.spool.enqueue(self.message('First'))
+        self.spool.enqueue(self.message('Second'))
+
+        connection = get_connection(
+            'django.core.mail.backends.locmem.EmailBackend'
+        )
+        with self.assertMailsSent(2):
+            self.assertEqual(self.spool.drain(connection), (2, 0))
+
+        self.assertEqual([m.subject for m in mail.outbox[-2:]],
+                         ['First', 'Second'])
+        self.assertEqual(self.spool.keys(), [])
+
+    def test_drain__respects_limit(self):
+        """Spool().drain(.., limit=1) only sends one message
+        """
+
+        self.spool.enqueue(self.message('First'))
+        key = self.spool.enqueue(self.message('Second'))
+
+        connection = get_connection(
+            'django.core.mail.backends.locmem.EmailBackend'
+        )
+        with self.assertMailsSent(1):
+            self.assertEqual(self.spool.drain(connection, limit=1), (1, 0))
+
+        self.assertEqual(mail.outbox[-1].subject, 'First')
+        self.assertEqual(self.spool.keys(), [key])
+
+    def test_drain__keeps_messages_not_due(self):
+        """Spool().drain(..) keeps messages that are not due
+        """
+
+        self.spool.enqueue(self.message('First'))
+        key = self.spool.enqueue(self.message('Second'),
+                                 datetime.now() + timedelta(hours=1))
+
+        connection = get_connection(
+            'django.core.mail.backends.locmem.EmailBackend'
+        )
+        with self.assertMailsSent(1):
+            self.assertEqual(self.spool.drain(connection), (1, 0))
+
+        self.assertEqual(mail.outbox[-1].subject, 'First')
+        self.assertEqual(self.spool.keys(), [key])
+
+    def test_drain__keeps_failed_messages(self):
+        """Spool().drain(..) keeps messages that failed to send
+        """
+
+        key = self.spool.enqueue(self.message())
+
+        self.assertEqual(self.spool.drain(FailingBackend()), (0, 1))
+        self.assertEqual(self.spool.keys(), [key])
+
+    def test_drain__skips_locked_spool(self):
+        """Spool().drain(..) sends nothing while another drain is running
+        """
+
+        key = self.spool.enqueue(self.message())
+
+        connection = get_connection(
+            'django.core.mail.backends.locmem.EmailBackend'
+        )
+        with open(os.path.join(self.path, '.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            with self.assertMailsSent(0):
+                self.assertEqual(self.spool.drain(connection), (0, 0))
+            self.assertEqual(self.spool.keys(), [key])
+
+        with self.assertMailsSent(1):
+            self.assertEqual(self.spool.drain(connection), (1, 0))
+
+    def test_drain_spool__command(self):
+        """drain_spool sends through PALOMA_SPOOL_BACKEND and reports counts
+        """
+
+        self.spool.enqueue(self.message('First'))
+        self.spool.enqueue(self.message('Second'))
+
+        with override_settings(
+                PALOMA_SPOOL_DIR=self.path,
+                PALOMA_SPOOL_BACKEND='paloma.tests.backends.FailingBackend'):
+            stdout = StringIO()
+            with self.assertMailsSent(0):
+                call_command('drain_spool', limit=1, stdout=stdout)
+            self.assertEqual(stdout.getvalue(), 'Sent 0 messages, 1 failed.\n')
+
+        with override_settings(
+                PALOMA_SPOOL_DIR=self.path,
+                PALOMA_SPOOL_BACKEND=(
+                    'django.core.mail.backends.locmem.EmailBackend'
+                )):
+            stdout = StringIO()
+            with self.assertMailsSent(1):
+                call_command('drain_spool', limit=1, stdout=stdout)
+            self.assertEqual(stdout.getvalue(), 'Sent 1 message, 0 failed.\n')
+
+        self.assertEqual(mail.outbox[-1].subject, 'First')
+        self.assertEqual(len(self.spool.keys()), 1)
+
+    def test_get_spool__requires_setting(self):
+        """get_spool() requires the PALOMA_SPOOL_DIR setting
+        """
+
+        with override_settings(PALOMA_SPOOL_DIR=None):
+            self.assertRaises(ImproperlyConfigured, get_spool)
+
+        with override_settings(PALOMA_SPOOL_DIR=self.path):
+            self.assertEqual(get_spool().path, self.path)
+
+
+@override_settings(DEFAULT_FROM_EMAIL='default@example.com',
+                   DEFAULT_FROM_NAME='Default sender')
+class SpoolBackendTestCase(TestCase):
+    """Test case for :class:`SpoolBackend`.
+    """
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_send__spools_message(self):
+        """Mail().send(..) through SpoolBackend spools instead of sending
+        """
+
+        class TestMail(Mail):
+            subject = 'Subject of the e-mail'
+
+        with override_settings(
+                EMAIL_BACKEND='paloma.backends.SpoolBackend',
+                PALOMA_SPOOL_DIR=self.path):
+            with self.assertMailsSent(0):
+                TestMail().send('test@example.com',
+                                'Body of the e-mail',
+                                tags=['test'])
+
+        spool = Spool(self.path)
+        keys = spool.keys()
+        self.assertEqual(len(keys), 1)
+
+        message = spool.load(keys[0])
+        self.assertEqual(message.subject, 'Subject of the e-mail')
+        self.assertEqual(message.body, 'Body of the e-mail')
+        self.assertEqual(message.tags, ['test'])
+
+    def test_send_messages__skips_messages_without_recipients(self):
+        """SpoolBackend().send_messages(..) skips messages without recipients
+        """
+
+        with override_settings(PALOMA_SPOOL_DIR=self.path):
+            backend = SpoolBackend()
+
+        message = EmailMessage('Subject of the e-mail',
+                               'Body of the e-mail',
+                               'default@example.com',
+                               [])
+        self.assertEqual(backend.send_messages([message]), 0)
+        self.assertEqual(Spool(self.path).keys(), [])
+
+
+__all__ = (
+    'SpoolTestCase',
+    'SpoolBackendTestCase',
+)
@@ -0,0 +1,10 @@
+from django.conf.urls import url
+
+from . import views
+
+
+urlpatterns = [
+    url(r'^attachments/(?P<token>[^/]+)/$',
+        views.attachment,
+        name='paloma-attachment'),
+]
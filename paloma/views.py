@@ -0,0 +1,61 @@
+import mimetypes
+import os
+
+from django.core import signing
+from django.http import Http404, HttpResponse
+
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    StreamingHttpResponse = HttpResponse
+
+from .attachments import get_attachment_store, load_attachment_token
+
+
+def read_chunks(path, chunk_size=64 * 1024):
+    """Read a file in chunks.
+
+    The file is closed once read, or when the generator is closed.
+
+    :param path: Path of the file.
+    :param chunk_size: Size of the chunks in bytes.
+    """
+
+    attachment_file = open(path, 'rb')
+    try:
+        while True:
+            chunk = attachment_file.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        attachment_file.close()
+
+
+def attachment(request, token):
+    """Serve an offloaded attachment.
+
+    :param token: Signed token of the attachment.
+    """
+
+    try:
+        digest, filename, mime_type = load_attachment_token(token)
+    except signing.BadSignature:
+        raise Http404
+
+    path = get_attachment_store().get_path(digest)
+    if not os.path.exists(path):
+        raise Http404
+
+    if not mime_type:
+        mime_type = mimetypes.guess_type(filename)[0] or \
+            'application/octet-stream'
+
+    response = StreamingHttpResponse(read_chunks(path),
+                                     content_type=mime_type)
+    response['Content-Disposition'] = 'attachment; filename="%s"' % (
+        filename.replace('\\', '\\\\').replace('"', '\\"')
+    )
+    response['Content-Length'] = os.path.getsize(path)
+
+    return response
@@ -6,6 +6,8 @@ except ImportError:
 
 packages = [
     'paloma',
+    'paloma.management',
+    'paloma.management.commands',
 ]
 
 requires = [